@@ -82,6 +82,11 @@ def prepare_args(root_dir):
                         help="if true, we will use the regressed box produced by localizer to calculate the loss.")
     parser.add_argument('--rematch_overlap_threshold', type=float, default=0.7,
                         help='overlap threshold to match prior to ground truth after regression')
+    parser.add_argument('--hungarian_match', action="store_true",
+                        help="assign a distinct best prior to each ground truth with the hungarian algorithm "
+                             "(requires scipy)")
+    parser.add_argument('--bf16_match', action="store_true",
+                        help="compute the jaccard overlap between priors and ground truth in bfloat16")
 
 
     # Training Parameter
@@ -100,6 +105,16 @@ def prepare_args(root_dir):
                         help='Batch size for training')
     parser.add_argument('--num_workers', default=6, type=int,
                         help='Number of workers used in dataloading')
+    parser.add_argument('--gpu_augment', action="store_true",
+                        help="apply the photometric distortion and mean subtraction on the gpu per batch "
+                             "instead of in the dataloader workers")
+    parser.add_argument('--compile', action="store_true",
+                        help="compile the network with torch.compile (PyTorch 2.0+)")
+    parser.add_argument('--amp', action="store_true",
+                        help="run the forward pass under fp16 autocast and scale the loss with a GradScaler")
+    parser.add_argument('--distributed', action="store_true",
+                        help="train with DistributedDataParallel, one process per visible gpu, "
+                             "batch_size is split between the processes")
 
     # Optimizer
     parser.add_argument('--optimizer', default="adam", type=str, choices=["adam", "sgd", "super"],
@@ -137,6 +152,9 @@ def prepare_args(root_dir):
     parser.add_argument('--gt_replace', action="store_true",
                         help="replace the prior box with ground truth box when IoU is bigger than 0.6")
     args = parser.parse_args()
+    if args.amp and (args.deformation or args.loc_deformation):
+        # mmdet's DeformConv is a custom autograd Function that autocast does not cast
+        parser.error("--amp is not supported together with --deformation or --loc_deformation")
     if not os.path.exists(args.save_folder):
         os.mkdir(args.save_folder)
     return args
\ No newline at end of file
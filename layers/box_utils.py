@@ -1,7 +1,52 @@
 # -*- coding: utf-8 -*-
+from functools import lru_cache
+from typing import List, NamedTuple
 import torch
+from torch.nn.utils.rnn import pad_sequence
+try:
+    from torchvision.ops import nms as tv_nms
+except ImportError:
+    tv_nms = None
 
+# Set to False to force the pure PyTorch nms even when torchvision is installed
+USE_TORCHVISION_NMS = tv_nms is not None
 
+
+class BoxesSoA(NamedTuple):
+    """Point form boxes stored as four 1-D tensors (structure of arrays),
+    so kernels reading one coordinate do not stride over the other three.
+    """
+    x1: torch.Tensor
+    y1: torch.Tensor
+    x2: torch.Tensor
+    y2: torch.Tensor
+
+    @classmethod
+    def from_xyxy(cls, boxes):
+        """Copy [num_boxes,4] point form boxes into four contiguous tensors"""
+        return cls(*boxes.t().contiguous())
+
+    def xyxy(self):
+        """Materialize the [num_boxes,4] point form tensor"""
+        return torch.stack(self, 1)
+
+    def area(self):
+        return (self.x2 - self.x1) * (self.y2 - self.y1)
+
+    def to(self, dtype):
+        return BoxesSoA(*(column.to(dtype) for column in self))
+
+
+def as_soa(boxes):
+    """View [num_boxes,4] point form boxes as BoxesSoA without copying,
+    BoxesSoA inputs are returned unchanged.
+    """
+    if isinstance(boxes, BoxesSoA):
+        return boxes
+    return BoxesSoA(*boxes.unbind(1))
+
+
+@torch.jit.script
 def point_form(boxes):
     """ Convert prior_boxes to (xmin, ymin, xmax, ymax)
     representation for comparison to point form ground truth data.
@@ -14,6 +59,7 @@ def point_form(boxes):
                      boxes[:, :2] + boxes[:, 2:]/2), 1)  # xmax, ymax
 
 
+@torch.jit.script
 def center_size(boxes):
     """ Convert prior_boxes to (cx, cy, w, h)
     representation for comparison to center-size form ground truth data.
@@ -27,48 +73,94 @@ def center_size(boxes):
 
 
 def intersect(box_a, box_b):
-    """ We resize both tensors to [A,B,2] without new malloc:
-    [A,2] -> [A,1,2] -> [A,B,2]
-    [B,2] -> [1,B,2] -> [A,B,2]
+    """ We broadcast the coordinate columns of both tensors against each other:
+    [A,1] op [B] -> [A,B]
+    so the intersection width and height are computed directly as [A,B]
+    tensors, no [A,B,2] tensor is ever created.
     Then we compute the area of intersect between box_a and box_b.
     Args:
-      box_a: (tensor) bounding boxes, Shape: [A,4].
-      box_b: (tensor) bounding boxes, Shape: [B,4].
+      box_a: (tensor or BoxesSoA) bounding boxes, Shape: [A,4].
+      box_b: (tensor or BoxesSoA) bounding boxes, Shape: [B,4].
     Return:
       (tensor) intersection area, Shape: [A,B].
     """
-    A = box_a.size(0)
-    B = box_b.size(0)
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(A, B, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, :2].unsqueeze(0).expand(A, B, 2))
-    inter = torch.clamp((max_xy - min_xy), min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    box_a, box_b = as_soa(box_a), as_soa(box_b)
+    inter_w = (torch.min(box_a.x2.unsqueeze(1), box_b.x2) -
+               torch.max(box_a.x1.unsqueeze(1), box_b.x1)).clamp_(min=0)
+    inter_h = (torch.min(box_a.y2.unsqueeze(1), box_b.y2) -
+               torch.max(box_a.y1.unsqueeze(1), box_b.y1)).clamp_(min=0)
+    return inter_w.mul_(inter_h)
 
 
-def jaccard(box_a, box_b):
+def jaccard(box_a, box_b, out=None):
     """Compute the jaccard overlap of two sets of boxes.  The jaccard overlap
     is simply the intersection over union of two boxes.  Here we operate on
     ground truth boxes and default boxes.
     E.g.:
         A ∩ B / A ∪ B = A ∩ B / (area(A) + area(B) - A ∩ B)
     Args:
-        box_a: (tensor) Ground truth bounding boxes, Shape: [num_objects,4]
-        box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]
+        box_a: (tensor or BoxesSoA) Ground truth bounding boxes, Shape: [num_objects,4]
+        box_b: (tensor or BoxesSoA) Prior boxes from priorbox layers, Shape: [num_priors,4]
+        out: (tensor, optional) Scratch buffer to hold the union,
+            Shape: [num_objects,num_priors]
     Return:
         jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]
     """
     inter = intersect(box_a, box_b)
-    area_a = ((box_a[:, 2]-box_a[:, 0]) *
-              (box_a[:, 3]-box_a[:, 1])).unsqueeze(1).expand_as(inter)  # [A,B]
-    area_b = ((box_b[:, 2]-box_b[:, 0]) *
-              (box_b[:, 3]-box_b[:, 1])).unsqueeze(0).expand_as(inter)  # [A,B]
-    union = area_a + area_b - inter
-    return inter / union  # [A,B]
+    area_a = get_box_size(box_a)  # [A]
+    area_b = get_box_size(box_b)  # [B]
+    union = torch.add(area_a.unsqueeze(1), area_b, out=out).sub_(inter)
+    return inter.div_(union)  # [A,B]
+
 
+_UNION_BUFFERS = {}
 
-def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx, visualize=False):
+
+def union_buffer(num_objects, priors):
+    """Scratch buffer for the union in jaccard, recycled across match calls.
+    One buffer is kept per (num_priors, device, dtype) and grown to the
+    largest num_objects seen so far.
+    Args:
+        num_objects: (int) number of ground truth boxes
+        priors: (tensor or BoxesSoA) Prior boxes, Shape: [num_priors,4]
+    Return:
+        (tensor) Shape: [num_objects,num_priors]
+    """
+    column = as_soa(priors).x1
+    key = (column.size(0), column.device, column.dtype)
+    buffer = _UNION_BUFFERS.get(key)
+    if buffer is None or buffer.size(0) < num_objects:
+        buffer = column.new_empty((num_objects, column.size(0)))
+        _UNION_BUFFERS[key] = buffer
+    return buffer[:num_objects]
+
+
+def hungarian_best_priors(overlaps, top_k=10):
+    """Assign a distinct prior to each ground truth by maximizing the total
+    jaccard overlap (Hungarian algorithm), instead of letting every ground
+    truth greedily take its best prior even when another one already did.
+    Only the union of the top_k priors of each ground truth is considered
+    to keep the cost matrix small.
+    Args:
+        overlaps: (tensor) jaccard overlap, Shape: [num_objects,num_priors].
+        top_k: (int) number of candidate priors per ground truth.
+    Return:
+        (tensor) index of the prior assigned to each ground truth, Shape: [num_objects].
+    """
+    from scipy.optimize import linear_sum_assignment
+    best_prior_idx = overlaps.argmax(1)
+    candidates = overlaps.topk(min(top_k, overlaps.size(1)), dim=1)[1].view(-1).unique()
+    # float() since numpy has no bfloat16, for overlaps computed with --bf16_match
+    row_ind, col_ind = linear_sum_assignment(-overlaps[:, candidates].float().cpu().numpy())
+    # ground truths left without a candidate keep their greedy best prior
+    row_ind = torch.as_tensor(row_ind, dtype=torch.long, device=overlaps.device)
+    col_ind = torch.as_tensor(col_ind, dtype=torch.long, device=overlaps.device)
+    best_prior_idx[row_ind] = candidates[col_ind]
+    return best_prior_idx
+
+
+def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx, visualize=False,
+          priors_point_form=None, hungarian=False, iou_dtype=None):
     """Match each prior box with the ground truth box of the highest jaccard
     overlap, encode the bounding boxes, then return the matched indices
     corresponding to both confidence and location preds.
@@ -82,35 +174,48 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx, visu
         loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
         conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
         idx: (int) current batch index
+        priors_point_form: (tensor or BoxesSoA, optional) point_form(priors), pass it when
+            the same priors are matched against several images.
+        hungarian: (bool) assign a distinct prior to each ground truth with
+            hungarian_best_priors instead of the greedy best prior.
+        iou_dtype: (torch.dtype, optional) dtype to compute the jaccard overlap
+            in, e.g. torch.bfloat16 to halve its memory traffic. The encoded
+            targets are always computed from the full precision boxes.
     Return:
         The matched indices corresponding to 1)location and 2)confidence preds.
     """
+    if priors_point_form is None:
+        # the overlaps only feed argmax and thresholds, detach them so the out=
+        # buffers of jaccard also work on regressed priors that require grad
+        priors_point_form = point_form(priors.detach())
+    truths_iou = truths
+    if iou_dtype is not None:
+        # no-op when the caller already converted the shared priors
+        truths_iou = truths.to(iou_dtype)
+        priors_point_form = priors_point_form.to(iou_dtype)
     # jaccard index
     overlaps = jaccard(
-        truths,
-        point_form(priors)
+        truths_iou,
+        priors_point_form,
+        out=union_buffer(truths.size(0), priors_point_form)
     )
     # (Bipartite Matching)
-    # [1,num_objects] best prior for each ground truth
-    best_prior_overlap, best_prior_idx = overlaps.max(1, keepdim=True)
-    # [1,num_priors] best ground truth for each prior
-    best_truth_overlap, best_truth_idx = overlaps.max(0, keepdim=True)
+    # [num_objects] best prior for each ground truth
+    if hungarian:
+        best_prior_idx = hungarian_best_priors(overlaps)
+    else:
+        best_prior_idx = overlaps.argmax(1)
+    # [num_priors] best ground truth for each prior
+    best_truth_overlap, best_truth_idx = overlaps.max(0)
 
     #tmp = best_truth_overlap.repeat(truths.size(0), 1) - overlaps
     #(torch.sum(tmp > 0.2, dim=0) == 3) * (best_truth_overlap.squeeze() > threshold)
 
-    best_truth_idx.squeeze_(0)
-    best_truth_overlap.squeeze_(0)
-    best_prior_idx.squeeze_(1)
-    best_prior_overlap.squeeze_(1)
-    best_truth_idx[best_prior_idx] = torch.arange(best_prior_idx.size(0))
-    #print(best_truth_idx[best_prior_idx])
-    #best_truth_overlap.index_fill_(0, best_prior_idx, 2)  # ensure best prior
+    best_truth_overlap.index_fill_(0, best_prior_idx, 2)  # ensure best prior
     # ensure every gt matches with its prior of max overlap
-    for j in range(best_prior_idx.size(0)):
-        best_truth_idx[best_prior_idx[j]] = j
-    #print(best_truth_idx[best_prior_idx])
-    #print("")
+    best_truth_idx.index_copy_(0, best_prior_idx,
+                               torch.arange(best_prior_idx.size(0), dtype=torch.long,
+                                            device=best_truth_idx.device))
     matches = truths[best_truth_idx]          # Shape: [num_priors,4]
     conf = labels[best_truth_idx] + 1         # Shape: [num_priors]
     conf[best_truth_overlap < threshold] = 0  # label as background
@@ -121,7 +226,61 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx, visu
     conf_t[idx] = conf  # [num_priors] top class label for each prior
 
 
-def encode(matched, priors, variances):
+def match_batched(threshold, truths, priors, variances, labels, loc_t, conf_t,
+                  priors_point_form=None, iou_dtype=None):
+    """Batched version of match for a batch of images sharing the same priors.
+    The ground truths are padded to [batch,max_num_obj,4] so the jaccard
+    overlap, the bipartite matching and the encoding of the whole batch are
+    done in one pass instead of one match call per image.
+    Args:
+        threshold: (float) The overlap threshold used when mathing boxes.
+        truths: (list of tensor) Ground truth boxes of each image, Shape: [num_obj,4].
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4].
+        variances: (list[float]) Variances of priorboxes
+        labels: (list of tensor) Class labels of each image, Shape: [num_obj].
+        loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
+        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
+        priors_point_form: see match
+        iou_dtype: see match
+    """
+    num, num_priors = loc_t.size(0), priors.size(0)
+    device = priors.device
+    if priors_point_form is None:
+        priors_point_form = point_form(priors)
+    truths_padded = pad_sequence(truths, batch_first=True)  # [num,max_obj,4]
+    labels_padded = pad_sequence(labels, batch_first=True)  # [num,max_obj]
+    max_obj = truths_padded.size(1)
+    num_obj = torch.tensor([t.size(0) for t in truths], device=device)
+    obj_range = torch.arange(max_obj, device=device)
+    valid = obj_range.unsqueeze(0) < num_obj.unsqueeze(1)  # [num,max_obj]
+    truths_iou = truths_padded
+    if iou_dtype is not None:
+        truths_iou = truths_padded.to(iou_dtype)
+        priors_point_form = priors_point_form.to(iou_dtype)
+    # jaccard index, padded ground truths never win a prior
+    overlaps = jaccard(truths_iou.view(-1, 4), priors_point_form,
+                       out=union_buffer(num * max_obj, priors_point_form)).view(num, max_obj, num_priors)
+    overlaps.masked_fill_(~valid.unsqueeze(2), -1)
+    # (Bipartite Matching)
+    # [num,max_obj] best prior for each ground truth
+    best_prior_idx = overlaps.argmax(2)
+    # [num,num_priors] best ground truth for each prior
+    best_truth_overlap, best_truth_idx = overlaps.max(1)
+    # index the flattened [num*num_priors] view with the real ground truths only
+    flat_prior_idx = (best_prior_idx + torch.arange(num, device=device).unsqueeze(1) * num_priors)[valid]
+    best_truth_overlap.view(-1).index_fill_(0, flat_prior_idx, 2)  # ensure best prior
+    # ensure every gt matches with its prior of max overlap
+    best_truth_idx.view(-1).index_copy_(0, flat_prior_idx, obj_range.expand(num, max_obj)[valid])
+    matches = truths_padded.gather(1, best_truth_idx.unsqueeze(2).expand(num, num_priors, 4))
+    conf = labels_padded.gather(1, best_truth_idx) + 1  # Shape: [num,num_priors]
+    conf[best_truth_overlap < threshold] = 0  # label as background
+    loc = encode(matches.view(-1, 4), priors.repeat(num, 1), variances)
+    loc_t.copy_(loc.view(num, num_priors, 4))
+    conf_t.copy_(conf)
+
+
+@torch.jit.script
+def encode(matched, priors, variances: List[float]):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
     Args:
@@ -146,7 +305,8 @@ def encode(matched, priors, variances):
 
 
 # Adapted from https://github.com/Hakuyume/chainer-ssd
-def decode(loc, priors, variances):
+@torch.jit.script
+def decode(loc, priors, variances: List[float]):
     """Decode locations from predictions using priors to undo
     the encoding we did for offset regression at train time.
     Args:
@@ -167,6 +327,7 @@ def decode(loc, priors, variances):
     return boxes
 
 
+@torch.jit.script
 def log_sum_exp(x):
     """Utility function for computing log_sum_exp while determining
     This will be used to determine unaveraged confidence loss across
@@ -174,82 +335,72 @@ def log_sum_exp(x):
     Args:
         x (Variable(tensor)): conf_preds from conf layers
     """
-    x_max = x.data.max()
-    return torch.log(torch.sum(torch.exp(x-x_max), 1, keepdim=True)) + x_max
+    return torch.logsumexp(x, 1, keepdim=True)
 
 
-# Original author: Francisco Massa:
-# https://github.com/fmassa/object-detection.torch
-# Ported to PyTorch by Max deGroot (02/01/2017)
 def nms(boxes, scores, overlap=0.5, top_k=200):
     """Apply non-maximum suppression at test time to avoid detecting too many
     overlapping bounding boxes for a given object.
+    Uses the fused torchvision kernel when available, otherwise falls back
+    to the pure PyTorch implementation.
     Args:
         boxes: (tensor) The location preds for the img, Shape: [num_priors,4].
         scores: (tensor) The class predscores for the img, Shape:[num_priors].
         overlap: (float) The overlap thresh for suppressing unnecessary boxes.
         top_k: (int) The Maximum number of box preds to consider.
     Return:
-        The indices of the kept boxes with respect to num_priors.
+        The indices of the kept boxes with respect to num_priors,
+        and the number of kept boxes.
     """
+    if not USE_TORCHVISION_NMS:
+        return _nms_loop(boxes, scores, overlap, top_k)
+    # like the fallback, only the top_k highest scores are considered for suppression
+    scores, idx = scores.topk(min(top_k, scores.numel()))
+    keep = idx[tv_nms(boxes[idx], scores, overlap)]
+    return keep, keep.numel()
+
 
-    keep = scores.new(scores.size(0)).zero_().long()
+# Original author: Francisco Massa:
+# https://github.com/fmassa/object-detection.torch
+# Ported to PyTorch by Max deGroot (02/01/2017)
+def _nms_loop(boxes, scores, overlap=0.5, top_k=200):
+    """Pure PyTorch fallback of nms, see nms for the arguments.
+    The pairwise IoU of the top_k boxes is computed once, then the boxes are
+    walked in descending score order and each kept box suppresses all the
+    lower scored boxes overlapping it, with a single boolean alive mask.
+    """
     if boxes.numel() == 0:
-        return keep
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    area = torch.mul(x2 - x1, y2 - y1)
-    v, idx = scores.sort(0)  # sort in ascending order
-    # I = I[v >= 0.01]
-    idx = idx[-top_k:]  # indices of the top-k largest vals
-    xx1 = boxes.new()
-    yy1 = boxes.new()
-    xx2 = boxes.new()
-    yy2 = boxes.new()
-    w = boxes.new()
-    h = boxes.new()
-
-    # keep = torch.Tensor()
-    count = 0
-    while idx.numel() > 0:
-        i = idx[-1]  # index of current largest val
-        # keep.append(i)
-        keep[count] = i
-        count += 1
-        if idx.size(0) == 1:
-            break
-        idx = idx[:-1]  # remove kept element from view
-        # load bboxes of next highest vals
-        torch.index_select(x1, 0, idx, out=xx1)
-        torch.index_select(y1, 0, idx, out=yy1)
-        torch.index_select(x2, 0, idx, out=xx2)
-        torch.index_select(y2, 0, idx, out=yy2)
-        # store element-wise max with next highest score
-        xx1 = torch.clamp(xx1, min=x1[i])
-        yy1 = torch.clamp(yy1, min=y1[i])
-        xx2 = torch.clamp(xx2, max=x2[i])
-        yy2 = torch.clamp(yy2, max=y2[i])
-        w.resize_as_(xx2)
-        h.resize_as_(yy2)
-        w = xx2 - xx1
-        h = yy2 - yy1
-        # check sizes of xx1 and xx2.. after each iteration
-        w = torch.clamp(w, min=0.0)
-        h = torch.clamp(h, min=0.0)
-        inter = w*h
-        # IoU = i / (area(a) + area(b) - i)
-        rem_areas = torch.index_select(area, 0, idx)  # load remaining areas)
-        union = (rem_areas - inter) + area[i]
-        IoU = inter/union  # store result in iou
-        # keep only elements with an IoU <= overlap
-        idx = idx[IoU.le(overlap)]
-    return keep, count
+        return scores.new_zeros(0).long(), 0
+    v, idx = scores.sort(0, descending=True)
+    idx = idx[:top_k]  # indices of the top-k largest vals
+    top_boxes = BoxesSoA.from_xyxy(boxes[idx])
+    # walk the overlap matrix on cpu to avoid one sync per kept box,
+    # disjoint[i, j] tells whether box j survives when box i is kept
+    disjoint = jaccard(top_boxes, top_boxes).le(overlap).cpu()
+    alive = torch.ones(idx.size(0), dtype=torch.bool, device=disjoint.device)
+    for i in range(idx.size(0)):
+        if alive[i]:
+            alive[i + 1:] &= disjoint[i, i + 1:]
+    keep = idx[alive.to(idx.device)]
+    return keep, keep.numel()
+
+@lru_cache(maxsize=None)
+def _noise_distortion(v3_form, device_index, kernel_size=3):
+    """Distortion directions used by add_noise for wide and for tall boxes"""
+    if v3_form:
+        distortion = torch.FloatTensor([0, -1, 0, -1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 1]).cuda(
+            device_index)
+    else:
+        distortion = torch.FloatTensor([-1, 0, -1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 1, 0]).cuda(
+            device_index)
+    distortion2 = distortion.view(kernel_size, kernel_size, 2).permute(1, 0, 2)[:, :, (1, 0)].contiguous().view(-1)
+    return distortion, distortion2
+
 
 def add_noise(bboxes, kernel_size, v3_form):
-    ratios = (bboxes[:, 2] - bboxes[:, 0]) / (bboxes[:, 3] - bboxes[:, 1])
-    max_length = torch.max(torch.stack(((bboxes[:, 2] - bboxes[:, 0]), (bboxes[:, 3] - bboxes[:, 1])), dim=1), dim=1)[0]
+    w, h = (bboxes[:, 2:] - bboxes[:, :2]).unbind(1)
+    ratios = w / h
+    max_length = torch.max(w, h)
     # ratios计算方法为宽高比，所以small_idx代表比较高的box
     small_idx = ratios < 1
     one_idx = (ratios >= 0.9) * (ratios <= 1.1)
@@ -259,24 +410,27 @@ def add_noise(bboxes, kernel_size, v3_form):
     # offsets = (torch.tanh(0.3 * (ratios - 5)) / 2 + 0.5) * max_length / (kernel_size ** 2)
     offsets = torch.tanh(0.25 * ratios) * max_length / (kernel_size ** 2)
     offsets[one_idx] = 0
-    offsets = offsets.unsqueeze(-1).repeat(1, 2 * kernel_size ** 2)
+    offsets = offsets.unsqueeze(-1)
 
     assert kernel_size == 3, "偏移量是为kernel size=3时设计的"
-    if v3_form:
-        distortion = torch.FloatTensor([0, -1, 0, -1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 1]).cuda(
-            bboxes.device.index)
-    else:
-        distortion = torch.FloatTensor([-1, 0, -1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 1, 0]).cuda(
-            bboxes.device.index)
-    distortion2 = distortion.view(kernel_size, kernel_size, 2).permute(1, 0, 2)[:, :, (1, 0)].contiguous().view(-1)
-    distortions = distortion.unsqueeze(0).repeat(bboxes.size(0), 1)
-    distortions[small_idx] = distortion2
+    distortion, distortion2 = _noise_distortion(v3_form, bboxes.device.index)
+    distortions = torch.where(small_idx.unsqueeze(1), distortion2.unsqueeze(0), distortion.unsqueeze(0))
     distortions = distortions * offsets
-    noise = torch.randn(distortions.size(0)) < 0
+    sign = (torch.rand(distortions.size(0), device=distortions.device) < 0.5).to(distortions.dtype).mul_(2).sub_(1)
     # 产生随机偏移方向。如果box较高，左侧的centroid会向上也会向下偏移（右侧与左侧相反）
     # 如果box较宽，上方的点会向左或向右偏移（上方与下方偏移方向相反）
-    distortions[noise] = distortions[noise] * -1
-    return distortions
+    return distortions.mul_(sign.unsqueeze_(1))
+
+@lru_cache(maxsize=None)
+def _conv_point_multiplier(kernel_size, device_index):
+    """Relative position of each kernel point inside a box, Shape: [2*kernel_size**2]"""
+    multiplier = torch.tensor([(2 * i + 1) / kernel_size / 2
+                               for i in range(kernel_size)]).cuda(device_index)
+    # multiplier生成的时候顺序先从上往下数，再从左往右数
+    # 应当换成先从左往右数，再从上往下数的顺序，所以有了[:, :, (1, 0)]
+    return torch.stack(torch.meshgrid([multiplier, multiplier]),
+                       dim=-1).contiguous().view(-1)
+
 
 def center_conv_point(bboxes, kernel_size=3, c_min=0, c_max=1, v3_form=False):
     """In a parallel manner also keeps the gradient during BP"""
@@ -285,13 +439,7 @@ def center_conv_point(bboxes, kernel_size=3, c_min=0, c_max=1, v3_form=False):
         base = torch.cat([bboxes[:, :2][:, (1, 0)]] * (kernel_size ** 2), dim=1)
     else:
         base = torch.cat([bboxes[:, :2]] * (kernel_size ** 2), dim=1)
-    multiplier = torch.tensor([(2 * i + 1) / kernel_size / 2
-                               for i in range(kernel_size)]).cuda(bboxes.device.index)
-    # multiplier生成的时候顺序先从上往下数，再从左往右数
-    # 应当换成先从左往右数，再从上往下数的顺序，所以有了[:, :, (1, 0)]
-    multiplier = torch.stack(torch.meshgrid([multiplier, multiplier]),
-                             dim=-1).contiguous().view(-1)
-    multiplier = multiplier.unsqueeze(0).repeat(bboxes.size(0), 1)
+    multiplier = _conv_point_multiplier(kernel_size, bboxes.device.index).unsqueeze(0)
     if v3_form:
         center = torch.stack([bboxes[:, 3] - bboxes[:, 1], bboxes[:, 2] - bboxes[:, 0]], dim=-1)
     else:
@@ -334,16 +482,20 @@ def measure(pred_boxes, gt_boxes, width, height):
         text_area = get_box_size(pred_boxes)
         gt_area = get_box_size(gt_boxes)
         num_sample = max(text_area.size(0),  gt_area.size(0))
-        accuracy = torch.sum(jaccard(pred_boxes, gt_boxes).max(0)[0]) / num_sample
+        # reuse inter instead of calling jaccard, which would compute it again
+        union = (text_area.unsqueeze(1) + gt_area).sub_(inter)
+        accuracy = torch.sum((inter / union).max(0)[0]) / num_sample
         precision = torch.sum(inter.max(1)[0] / text_area) / num_sample
         recall = torch.sum(inter.max(0)[0] / gt_area) / num_sample
         return float(accuracy), float(precision), float(recall)
 
 def get_box_size(box):
     """
-    calculate the bound box size
+    calculate the bound box size of a [num_boxes,4] tensor or BoxesSoA
     """
-    return (box[:, 2]-box[:, 0]) * (box[:, 3]-box[:, 1])
+    if isinstance(box, BoxesSoA):
+        return box.area()
+    return (box[:, 2:] - box[:, :2]).prod(1)
 
 def coord_to_rect(coord, height, width):
     """
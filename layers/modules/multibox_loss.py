@@ -6,7 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from data import coco as cfg
-from ..box_utils import match, log_sum_exp
+from ..box_utils import match, match_batched, log_sum_exp
 from layers.box_utils import *
 from ..visualization import *
 
@@ -76,36 +76,55 @@ class MultiBoxLoss(nn.Module):
         conf_t = torch.cuda.LongTensor(batch_num, num_priors)
         #loc_t = Variable(loc_t, requires_grad=False)
         #conf_t = Variable(conf_t, requires_grad=False)
+        # priors are shared by every image when not rematching
+        iou_dtype = torch.bfloat16 if self.args.bf16_match else None
+        priors_point_form = BoxesSoA.from_xyxy(point_form(priors.data))
+        if iou_dtype is not None:
+            priors_point_form = priors_point_form.to(iou_dtype)
 
+        all_truths, all_labels = [], []
         for idx in range(batch_num):
             if targets_idx is not None:
-                truths = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :-1].data
-                labels = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], -1].data
+                all_truths.append(targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :-1].data)
+                all_labels.append(targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], -1].data)
             else:
-                truths = targets[idx][:, :-1].data
-                labels = targets[idx][:, -1].data
-            if self.args.curr_epoch >= self.args.rematch and self.args.rematch != 0:
-            #if self.rematch:
-                defaults = center_size(decode(loc_data[idx], priors.data, self.variance))#.clamp(min=0, max=1))
-                if self.args.visualize_box:
-                    start_idx = priors.device.index * batch_num + idx
-                    _target = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :].data
-                    visualize_bbox(self.args, cfg, images[idx:idx+1], [_target], defaults, 0, prefix="reg",
-                                   start_idx=start_idx, show_detail=False)
-                    pass
-                threshold = self.args.rematch_overlap_threshold
-            else:
-                defaults = priors.data
-                threshold = self.threshold
-                if self.args.visualize_box:
-                    start_idx = priors.device.index * batch_num + idx
-                    _target = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :].data
-                    visualize_bbox(self.args, cfg, images[idx:idx+1], [_target], defaults, 0, prefix="reg",
-                                   start_idx=start_idx, show_detail=False)
-            match(threshold, truths, defaults, self.variance, labels, loc_t, conf_t, idx)
+                all_truths.append(targets[idx][:, :-1].data)
+                all_labels.append(targets[idx][:, -1].data)
+        rematching = self.args.curr_epoch >= self.args.rematch and self.args.rematch != 0
+
+        if not rematching and not self.args.hungarian_match and not self.args.visualize_box:
+            # every image is matched against the same priors, do it in one pass
+            match_batched(self.threshold, all_truths, priors.data, self.variance, all_labels, loc_t, conf_t,
+                          priors_point_form=priors_point_form, iou_dtype=iou_dtype)
+        else:
+            for idx in range(batch_num):
+                truths, labels = all_truths[idx], all_labels[idx]
+                if rematching:
+                #if self.rematch:
+                    defaults = center_size(decode(loc_data[idx], priors.data, self.variance))#.clamp(min=0, max=1))
+                    if self.args.visualize_box:
+                        start_idx = priors.device.index * batch_num + idx
+                        _target = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :].data
+                        visualize_bbox(self.args, cfg, images[idx:idx+1], [_target], defaults, 0, prefix="reg",
+                                       start_idx=start_idx, show_detail=False)
+                        pass
+                    defaults_point_form = None
+                    threshold = self.args.rematch_overlap_threshold
+                else:
+                    defaults = priors.data
+                    defaults_point_form = priors_point_form
+                    threshold = self.threshold
+                    if self.args.visualize_box:
+                        start_idx = priors.device.index * batch_num + idx
+                        _target = targets[targets_idx[idx][0]: targets_idx[idx][0] + targets_idx[idx][1], :].data
+                        visualize_bbox(self.args, cfg, images[idx:idx+1], [_target], defaults, 0, prefix="reg",
+                                       start_idx=start_idx, show_detail=False)
+                match(threshold, truths, defaults, self.variance, labels, loc_t, conf_t, idx,
+                      priors_point_form=defaults_point_form, hungarian=self.args.hungarian_match,
+                      iou_dtype=iou_dtype)
 
         # wrap targets
-        rematch = "Rematch" if self.args.curr_epoch >= self.args.rematch and self.args.rematch != 0 else "No_rematch"
+        rematch = "Rematch" if rematching else "No_rematch"
 
         pos = conf_t > 0
         #num_pos = pos.sum(dim=1, keepdim=True)
@@ -116,8 +135,11 @@ class MultiBoxLoss(nn.Module):
         loc_p = loc_data[pos_idx].view(-1, 4)
         loc_t = loc_t[pos_idx].view(-1, 4)
         loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False)
-        print("%s: Loc Loss: %.2f by %d positive match with %d images, avg: %.1f match per image."
-              % (rematch, float(loss_l), int(torch.sum(pos)), batch_num, int(torch.sum(pos)) / batch_num))
+        if self.args.visualize_box:
+            # debug output only, it syncs with the device on every call
+            num_match = int(torch.sum(pos))
+            print("%s: Loc Loss: %.2f by %d positive match with %d images, avg: %.1f match per image."
+                  % (rematch, float(loss_l), num_match, batch_num, num_match / batch_num))
         # Compute max conf across batch for hard negative mining
         batch_conf = conf_data.view(-1, self.num_classes)
         # batch_conf.gather(1, conf_t.view(-1, 1))
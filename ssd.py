@@ -39,8 +39,14 @@ class SSD(nn.Module):
         rf_Box = ReceptiveFieldPrior(self.cfg)
         prior = priorBox.forward()
         rf_prior = rf_Box.forward()
-        self.priors = [prior.cuda(i) for i in range(torch.cuda.device_count())]
-        self.rf_priors = [rf_prior.cuda(i) for i in range(torch.cuda.device_count())]
+        # priors are indexed by device, with one process per gpu (--distributed)
+        # only the current device is filled to avoid a cuda context on every gpu
+        if args.distributed:
+            devices = {torch.cuda.current_device()}
+        else:
+            devices = set(range(torch.cuda.device_count()))
+        self.priors = [prior.cuda(i) if i in devices else None for i in range(torch.cuda.device_count())]
+        self.rf_priors = [rf_prior.cuda(i) if i in devices else None for i in range(torch.cuda.device_count())]
         self.create_centroid()
         # SSD network
         self.vgg = nn.ModuleList(base)
@@ -62,10 +68,10 @@ class SSD(nn.Module):
     def create_centroid(self):
         self.prior_centeroids = [center_conv_point(point_form(prior),#.clamp(min=0, max=1),
                                                    v3_form=self.args.deformation_source.lower() == "geometric_v3")
-                                 for prior in self.priors]
+                                 if prior is not None else None for prior in self.priors]
         self.rf_prior_centeroids = [center_conv_point(point_form(rf_prior),
                                                       v3_form=self.args.deformation_source.lower() == "geometric_v3")
-                                    for rf_prior in self.rf_priors]
+                                    if rf_prior is not None else None for rf_prior in self.rf_priors]
 
     def forward(self, input, y=None, y_idx=None, deform_map=False, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -3,21 +3,24 @@ matplotlib.use('Agg')
 from data import *
 from layers import *
 from layers.box_utils import *
-from utils.augmentations import SSDAugmentation
+from utils.augmentations import SSDAugmentation, GPUPhotometricDistort
 from ssd import build_ssd
 import os, datetime
+from concurrent.futures import ThreadPoolExecutor
 import sys
 sys.path.append(os.path.expanduser("~/Documents"))
 import omni_torch.visualize.basic as vb
 from omni_torch.networks.optimizer import *
 import time
 import torch
-from torch.autograd import Variable
-import torch.nn as nn
 import torch.optim as optim
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.nn.init as init
 import torch.utils.data as data
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 from args import prepare_args
 import mmdet.ops.dcn as dcn
@@ -27,75 +30,120 @@ from layers.visualization import *
 args = prepare_args(VOC_ROOT)
 TMPJPG = os.path.expanduser("~/Pictures/tmp.jpg")
 torch.set_default_tensor_type('torch.cuda.FloatTensor')
+# TF32 convolutions and matmuls on Ampere and newer, autotuned from the first forward
+torch.backends.cuda.matmul.allow_tf32 = True
+cudnn.allow_tf32 = True
+cudnn.benchmark = True
+cudnn.deterministic = False
 
 dt = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M")
 
 
-def avg(list):
-    return sum(list) / len(list)
+def max_or_zero(tensor, dim):
+    """max of a 2D tensor along dim, zeros when that dim is empty"""
+    if tensor.size(dim) == 0:
+        return tensor.new_zeros(tensor.size(1 - dim))
+    return tensor.max(dim)[0]
+
+def worker_kwargs(args):
+    """Keep dataloader workers alive across epochs and let them prefetch a few
+    batches ahead, both options are only accepted when workers are used"""
+    if args.num_workers == 0:
+        return {}
+    return {"persistent_workers": True, "prefetch_factor": 4}
 
 def old_fit(args, cfg, net, train_set, optimizer, criterion):
     step_index = 0
-    train_loader = data.DataLoader(train_set, args.batch_size,
+    if args.distributed:
+        # args.batch_size is the global batch, split over the processes
+        sampler = DistributedSampler(train_set)
+        batch_size = args.batch_size // dist.get_world_size()
+    else:
+        sampler, batch_size = None, args.batch_size
+    train_loader = data.DataLoader(train_set, batch_size, sampler=sampler,
                                   num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
-                                  pin_memory=True)
+                                  shuffle=sampler is None, collate_fn=detection_collate,
+                                  pin_memory=True, **worker_kwargs(args))
+    epoch = 0
     # create batch iterator
     batch_iterator = iter(train_loader)
-    loc_losses, conf_losses = [], []
+    first_iter = args.start_iter + args.ft_iter
+    # location and confidence loss of each iteration, kept on the device and
+    # only synced when printed or plotted
+    loss_buf = torch.zeros(2, args.max_iter, device="cuda")
+    # host copy of loss_buf, only the iterations since the last plot are copied
+    loss_arr = np.empty((2, args.max_iter), dtype=np.float32)
+    synced = first_iter
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
+    priors = net.module.priors
+    # checkpoints are written in the background, one at a time
+    save_pool = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+    gpu_distort = GPUPhotometricDistort(MEANS) if args.gpu_augment else None
+    lr_steps = set(cfg['lr_steps'])
+    lrs = [args.lr * (args.gamma ** step) for step in range(len(cfg['lr_steps']) + 1)]
     #progress = open(os.path.join(args.save_folder, "%s_train_prog.txt" % args.name), "w")
-    for iteration in range(args.start_iter + args.ft_iter, args.max_iter):
+    for iteration in range(first_iter, args.max_iter):
         # print("iteration: %s"%iteration)
         args.curr_epoch = iteration
-        if iteration in cfg['lr_steps']:
+        if iteration in lr_steps:
             step_index += 1
-            adjust_learning_rate(optimizer, args.gamma, step_index)
+            adjust_learning_rate(optimizer, lrs[step_index])
         # load train data
         try:
-            images, targets, _shape = next(batch_iterator)
+            images, targets, _ = next(batch_iterator)
         except StopIteration:
+            epoch += 1
+            if sampler is not None:
+                sampler.set_epoch(epoch)
             batch_iterator = iter(train_loader)
-            images, targets, _shape = next(batch_iterator)
+            images, targets, _ = next(batch_iterator)
         t0 = time.time()
         #images = Variable(images.cuda())
         #targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
 
-        images = images.cuda()
-        targets = [ann.cuda() for ann in targets]
-        targets_idx_ = torch.cuda.LongTensor([ann.size(0) for ann in targets])
-        targets_idx = torch.cuda.LongTensor([sum(targets_idx_[:_idx]) for _idx in range(len(targets_idx_))])
-        y_idx = torch.stack([targets_idx, targets_idx_], dim=1)
-        y = torch.cat(targets, dim=0).repeat(torch.cuda.device_count(), 1)
+        images = images.cuda(non_blocking=True)
+        targets = [ann.cuda(non_blocking=True) for ann in targets]
+        if gpu_distort is not None:
+            images = gpu_distort(images)
 
         if iteration == 0 and args.visualize_box:
             # visualize_bbox(args, cfg, images, targets, net.module.priors[0], batch_idx)
             pass
         # forward
         #out = net(images)
-        out1, out2 = net(images, deform_map=False, test=False)
+        with torch.cuda.amp.autocast(enabled=args.amp):
+            out1, out2 = net(images, deform_map=False, test=False)
 
         # backprop
-        optimizer.zero_grad()
-        out = (out1, out2, net.module.priors)
+        optimizer.zero_grad(set_to_none=True)
+        # the loss stays in fp32, log_sum_exp of fp16 confidences can overflow
+        out = (out1.float(), out2.float(), priors)
         loss_l, loss_c = criterion(out, targets)
         #loss_l, loss_c = out1, out2
         loss = loss_l + loss_c
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         #loc_loss += loss_l.data
         #conf_loss += loss_c.data
-        loc_losses.append(float(loss_l.data))
-        conf_losses.append(float(loss_c.data))
+        loss_buf[0, iteration] = loss_l.detach()
+        loss_buf[1, iteration] = loss_c.detach()
         #result = "--loc_loss: %.4f conf_loss: %.4f--\n" % (float(loss_l.data), float(loss_c.data))
         #progress.write(result)
+        if args.rank != 0:
+            continue
         if iteration > 0 and iteration % 10 == 0:
             t1 = time.time()
+            loc_avg, conf_avg = loss_buf[:, max(iteration - 9, first_iter):iteration + 1].mean(1).tolist()
             print('timer: %.4f sec.' % (t1 - t0))
             print('iter ' + repr(iteration) + ' || Loss: %.4f || Conf_Loss: %.4f || Loc_Loss: %.4f ||' % (
-            loss.data, loss_c.data, loss_l.data), end=' ')
+            loc_avg + conf_avg, conf_avg, loc_avg), end=' ')
 
-        if iteration - args.start_iter - args.ft_iter > 0 and iteration % 100 == 0:
-            train_losses = [np.asarray(loc_losses), np.asarray(conf_losses)]
+        if iteration - first_iter > 0 and iteration % 100 == 0:
+            loss_arr[:, synced:iteration + 1] = loss_buf[:, synced:iteration + 1].cpu().numpy()
+            synced = iteration + 1
+            train_losses = [loss_arr[0, first_iter:synced], loss_arr[1, first_iter:synced]]
             vb.plot_curves(train_losses, ["location", "confidence"], save_path=args.val_log,
                            name=dt + "_" + args.name, window=25, fig_size=(18, 6),
                            bound={"low": 0.0, "high": 3.0}, title="Train Loss")
@@ -106,13 +154,20 @@ def old_fit(args, cfg, net, train_set, optimizer, criterion):
 
         if iteration > 5000 and iteration % 1000 == 0:
             print('Saving state, iter:', iteration)
-            torch.save(net.module.state_dict(),
-                       os.path.join(args.save_folder, '%s_%s_%s.pth' %
-                                    (args.name, args.img_size, repr(iteration))))
+            if pending_save is not None:
+                # re-raises any error of the previous save
+                pending_save.result()
+            state = {k: v.cpu() for k, v in net.module.state_dict().items()}
+            pending_save = save_pool.submit(torch.save, state,
+                                            os.path.join(args.save_folder, '%s_%s_%s.pth' %
+                                                         (args.name, args.img_size, repr(iteration))))
 
         # 由于centroid可以向两个方向形成distortion，所以每个epoch后都需要重新创建一次
         # 以保证两个方向都能够受到distortion
         # net.module.create_centroid()
+    if pending_save is not None:
+        pending_save.result()
+    save_pool.shutdown(wait=True)
 
 
 def val(args, net, val_set, optimizer):
@@ -120,116 +175,118 @@ def val(args, net, val_set, optimizer):
     val_loader = data.DataLoader(val_set, args.batch_size,
                                    num_workers=args.num_workers,
                                    shuffle=True, collate_fn=detection_collate,
-                                   pin_memory=True)
+                                   pin_memory=True, **worker_kwargs(args))
     # create batch iterator
     batch_iterator = iter(val_loader)
     eval_results = []
     start_time = time.time()
-    for iteration in range(args.start_iter + args.ft_iter, args.max_iter):
-        try:
-            images, targets, _shape = next(batch_iterator)
-        except StopIteration:
-            batch_iterator = iter(val_loader)
-            images, targets, _shape = next(batch_iterator)
-
-        images = Variable(images.cuda())
-        targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
-        out1, out2 = net(images, deform_map=False, test=False)
-        detections, reg_boxes = out1
-        eval_result = evaluate(images, detections.data, targets, iteration, 0.1,
-                               visualize=False, post_combine=True)
-        eval_results.append(eval_result)
-    eval_results = list(map(list, zip(*eval_results)))
+    with torch.no_grad():
+        for iteration in range(args.start_iter + args.ft_iter, args.max_iter):
+            try:
+                images, targets, _ = next(batch_iterator)
+            except StopIteration:
+                batch_iterator = iter(val_loader)
+                images, targets, _ = next(batch_iterator)
+
+            images = images.cuda(non_blocking=True)
+            targets = [ann.cuda(non_blocking=True) for ann in targets]
+            out1, out2 = net(images, deform_map=False, test=False)
+            detections, reg_boxes = out1
+            eval_result = evaluate(images, detections.data, targets, iteration, 0.1,
+                                   visualize=False, post_combine=True)
+            eval_results.append(eval_result)
+    # each eval_result is an (accuracy, precision, recall, f1) tuple
+    accu, pre, rec, f1 = np.asarray(eval_results).mean(0)
     print(" --- accuracy=%.4f, precision=%.4f, recall=%.4f, f1-score=%.4f, cost %.2f seconds ---" %
-          (avg(eval_results[0]), avg(eval_results[1]), avg(eval_results[2]),
-           avg(eval_results[3]), time.time() - start_time))
+          (accu, pre, rec, f1, time.time() - start_time))
 
 def evaluate(img, detections, targets, batch_idx, threshold, visualize=False, post_combine=False):
     eval_result = {}
     #save_dir = os.path.expanduser("~/Pictures/")
-    w = img.size(3)
-    h = img.size(2)
-    accu, pre, rec, f1 = [], [], [], []
+    num_classes = detections.size(1) - 1
+    # sum of accuracy, precision, recall, f1 and number of scored classes, kept on the device
+    score_sum = detections.new_zeros(4)
+    num_scored = detections.new_zeros(())
     for i in range(detections.size(0)):
-        gt_cls = targets[i][:, -1].data
-        tar = targets[i][:, :-1].data
-        gt_boxes = [[] for _ in range(20)]
-        for _i, cls in enumerate(gt_cls):
-            gt_boxes[int(cls)].append(tar[_i])
-
-        # enumerate through all classes
-        for j in range(1, detections.size(1)):
-            idx = detections[i, j, :, 0] >= threshold
-            boxes = detections[i, j, idx, 1:]
-            if boxes.size(0) == 0 and len(gt_boxes[j-1]) == 0:
-                continue
-            elif boxes.size(0) != 0 and len(gt_boxes[j-1]) == 0:
-                accuracy, precision, recall, f1_score = 0, 0, 1, 0
-            elif boxes.size(0) == 0 and len(gt_boxes[j-1]) != 0:
-                accuracy, precision, recall, f1_score = 0, 1, 0, 0
-            else:
-                gt = torch.stack(gt_boxes[j - 1], 0)
-                jac = jaccard(boxes, gt)
-                overlap, idx = jac.max(1, keepdim=True)
-                # This is not DetEval
-                positive_pred = boxes[overlap.squeeze(1) > 0.5]
-                negative_pred = boxes[overlap.squeeze(1) <= 0.5]
-                if negative_pred.size(0) == 0:
-                    negative_pred = tuple()
-                #print_box(blue_boxes=positive_pred, green_boxes=gt_boxes, red_boxes=negative_pred,
-                          #img=vb.plot_tensor(args, img, margin=0), save_dir=save_dir)
-
-                accuracy, precision, recall = measure(positive_pred, gt, width=w, height=h)
-                if (recall + precision) < 1e-3:
-                    f1_score = 0
-                else:
-                    f1_score = 2 * (recall * precision) / (recall + precision)
-                if visualize and threshold == 0.1 and i == 0:
-                    pred = [[float(coor) for coor in area] for area in positive_pred]
-                    gt = [[float(coor) for coor in area] for area in gt_boxes]
-                    #print_box(negative_pred, green_boxes=gt, blue_boxes=pred, idx=batch_idx,
-                              #img=vb.plot_tensor(args, img, margin=0), save_dir=args.val_log)
-            accu.append(accuracy)
-            pre.append(precision)
-            rec.append(recall)
-            f1.append(f1_score)
+        gt_cls = targets[i][:, -1].data.long()
+        gt = targets[i][:, :-1].data
+        # predictions of all classes at once, class c of detections matches gt label c - 1
+        keep = detections[i, 1:, :, 0].reshape(-1) >= threshold
+        boxes = detections[i, 1:, :, 1:].reshape(-1, 4)[keep]
+        pred_cls = torch.arange(num_classes, device=boxes.device).repeat_interleave(detections.size(2))[keep]
+
+        # overlaps between predictions and gt of different classes are zeroed
+        inter = intersect(boxes, gt).mul_(pred_cls.unsqueeze(1) == gt_cls.unsqueeze(0))
+        pred_area = get_box_size(boxes)
+        gt_area = get_box_size(gt)
+        jac = inter / (pred_area.unsqueeze(1) + gt_area - inter)
+        # This is not DetEval
+        positive = max_or_zero(jac, 1) > 0.5
+
+        # the per class measure() of positive predictions, as bincounts over the class index
+        pos_cls = pred_cls[positive]
+        num_pred = torch.bincount(pred_cls, minlength=num_classes)
+        num_gt = torch.bincount(gt_cls, minlength=num_classes)
+        num_sample = torch.max(torch.bincount(pos_cls, minlength=num_classes), num_gt).clamp(min=1).float()
+        accuracy = torch.bincount(gt_cls, max_or_zero(jac[positive], 0), minlength=num_classes) / num_sample
+        precision = torch.bincount(pos_cls, max_or_zero(inter[positive], 1) / pred_area[positive],
+                                   minlength=num_classes) / num_sample
+        recall = torch.bincount(gt_cls, max_or_zero(inter[positive], 0) / gt_area,
+                                minlength=num_classes) / num_sample
+        f1_score = torch.where(recall + precision < 1e-3, torch.zeros_like(recall),
+                               2 * (recall * precision) / (recall + precision))
+
+        # classes with only predictions or only gt
+        has_pred, has_gt = num_pred > 0, num_gt > 0
+        only_pred, only_gt = has_pred & ~has_gt, ~has_pred & has_gt
+        accuracy = accuracy.masked_fill(only_pred | only_gt, 0)
+        precision = precision.masked_fill(only_pred, 0).masked_fill(only_gt, 1)
+        recall = recall.masked_fill(only_pred, 1).masked_fill(only_gt, 0)
+        f1_score = f1_score.masked_fill(only_pred | only_gt, 0)
+        present = has_pred | has_gt
+        score_sum += torch.stack([accuracy, precision, recall, f1_score]).mul_(present).sum(1)
+        num_scored += present.sum()
+
+        if visualize and threshold == 0.1 and i == 0:
+            pred = boxes[positive].cpu().tolist()
+            gt = gt.cpu().tolist()
+            #print_box(negative_pred, green_boxes=gt, blue_boxes=pred, idx=batch_idx,
+                      #img=vb.plot_tensor(args, img, margin=0), save_dir=args.val_log)
         #eval_result.update({threshold: [avg(accu), avg(pre), avg(rec), avg(f1)]})
-    return avg(accu), avg(pre), avg(rec), avg(f1)
+    accu, pre, rec, f1 = (score_sum / num_scored).tolist()
+    return accu, pre, rec, f1
 
-def adjust_learning_rate(optimizer, gamma, step):
+def adjust_learning_rate(optimizer, lr):
     """Sets the learning rate to the initial LR decayed by 10 at every
-        specified step
+        specified step, lr is precomputed by the caller for that step
     # Adapted from PyTorch Imagenet example:
     # https://github.com/pytorch/examples/blob/master/imagenet/main.py
     """
-    lr = args.lr * (gamma ** (step))
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
 
+def _init_batchnorm(m):
+    torch.nn.init.constant_(m.weight, 1)
+    torch.nn.init.constant_(m.bias, 0)
+
+_INIT = {
+    torch.nn.Linear: lambda m: torch.nn.init.xavier_normal_(m.weight),
+    torch.nn.Conv2d: lambda m: torch.nn.init.kaiming_normal_(m.weight),
+    torch.nn.BatchNorm2d: _init_batchnorm,
+    dcn.DeformConv: lambda m: torch.nn.init.kaiming_normal_(m.weight),
+}
+
 def weights_init(m):
-    if type(m) == torch.nn.Linear:
-        torch.nn.init.xavier_normal_(m.weight)
-    elif type(m) == torch.nn.Conv2d:
-        torch.nn.init.kaiming_normal_(m.weight)
-    elif isinstance(m, torch.nn.BatchNorm2d):
-        torch.nn.init.constant_(m.weight, 1)
-        torch.nn.init.constant_(m.bias, 0)
-    else:
-        if type(m) is nn.ModuleList:
-            for _m in m:
-                if type(_m) == torch.nn.Linear:
-                    torch.nn.init.xavier_normal_(_m.weight)
-                elif type(_m) == torch.nn.Conv2d:
-                    torch.nn.init.kaiming_normal_(_m.weight)
-                elif isinstance(_m, torch.nn.BatchNorm2d):
-                    torch.nn.init.constant_(_m.weight, 1)
-                    torch.nn.init.constant_(_m.bias, 0)
-        elif type(m) is dcn.DeformConv:
-            torch.nn.init.kaiming_normal_(m.weight)
-        else:
-            pass
+    # Module.apply() already recurses into ModuleLists
+    fn = _INIT.get(type(m))
+    if fn is not None:
+        fn(m)
 
-def main():
+def main_worker(rank, world_size):
+    args.rank = rank
+    if args.distributed:
+        torch.cuda.set_device(rank)
+        dist.init_process_group("nccl", rank=rank, world_size=world_size)
     if args.dataset == 'COCO':
         if args.dataset_root == VOC_ROOT:
             if not os.path.exists(COCO_ROOT):
@@ -239,14 +296,16 @@ def main():
             args.dataset_root = COCO_ROOT
         cfg = coco
         train_set = COCODetection(root=args.dataset_root,
-                                transform=SSDAugmentation(cfg['min_dim'], MEANS))
+                                transform=SSDAugmentation(cfg['min_dim'], MEANS,
+                                                          photometric=not args.gpu_augment))
         val_set = None
     elif args.dataset == 'VOC':
         #if args.dataset_root == COCO_ROOT:
             #parser.error('Must specify dataset if specifying dataset_root')
         cfg = voc
         train_set = VOCDetection(root=args.dataset_root,
-                               transform=SSDAugmentation(cfg['min_dim'], MEANS))
+                               transform=SSDAugmentation(cfg['min_dim'], MEANS,
+                                                         photometric=not args.gpu_augment))
         val_set = VOCDetection(args.voc_root, [('2007', "test")],
                                BaseTransform(args.img_size, (104, 117, 123)),
                                VOCAnnotationTransform())
@@ -285,9 +344,15 @@ def main():
             ssd_net.loc.apply(weights_init)
             ssd_net.conf.apply(weights_init)
 
-    if args.cuda:
+    if args.distributed:
+        # some header branches are skipped depending on deform_map and the cfg
+        net = DDP(ssd_net.cuda(), device_ids=[rank], find_unused_parameters=True)
+    elif args.cuda:
         net = torch.nn.DataParallel(ssd_net).cuda()
-        cudnn.benchmark = True
+    if args.compile:
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("--compile requires PyTorch 2.0 or later")
+        net = torch.compile(net, mode='reduce-overhead', fullgraph=False)
 
     if args.optimizer.lower() == "adam":
         optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=args.weight_decay)
@@ -300,6 +365,8 @@ def main():
         raise NotImplementedError()
     criterion = MultiBoxLoss(voc['num_classes'], args, True, 0, True, 3, 0.5, False, args.cuda)
     old_fit(args, cfg, net, train_set, optimizer, criterion)
+    if args.distributed:
+        dist.destroy_process_group()
     """
     loc_loss, conf_loss = [], []
     accuracy, precision, recall, f1_score = [], [], [], []
@@ -341,5 +408,15 @@ def main():
         #net.module.create_centroid()
         """
 
+def main():
+    if args.distributed:
+        # one process per gpu, each re-imports this module and parses the same args
+        world_size = torch.cuda.device_count()
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        mp.spawn(main_worker, args=(world_size,), nprocs=world_size)
+    else:
+        main_worker(0, 1)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -3,6 +3,7 @@ from torchvision import transforms
 import cv2
 import numpy as np
 import types
+from functools import lru_cache
 from numpy import random
 
 
@@ -398,20 +399,107 @@ class PhotometricDistort(object):
 
 
 class SSDAugmentation(object):
-    def __init__(self, size=300, mean=(104, 117, 123)):
+    def __init__(self, size=300, mean=(104, 117, 123), photometric=True):
+        """
+        Args:
+            photometric (bool): if False, PhotometricDistort and SubtractMeans
+                are left out so they can be applied on the gpu to the whole
+                batch with GPUPhotometricDistort
+        """
         self.mean = mean
         self.size = size
         self.augment = Compose([
             ConvertFromInts(),
-            ToAbsoluteCoords(),
-            PhotometricDistort(),
+            ToAbsoluteCoords()] +
+            ([PhotometricDistort()] if photometric else []) + [
             Expand(self.mean),
             RandomSampleCrop(),
             RandomMirror(),
             ToPercentCoords(),
-            Resize(self.size),
-            SubtractMeans(self.mean)
-        ])
+            Resize(self.size)] +
+            ([SubtractMeans(self.mean)] if photometric else [])
+        )
 
     def __call__(self, img, boxes, labels):
         return self.augment(img, boxes, labels)
+
+
+def rgb_to_hsv(images):
+    """Convert a batch of rgb images to hsv with the same ranges as
+    cv2.COLOR_BGR2HSV on float images: h in [0, 360), s in [0, 1] and v = max(r, g, b)
+    Args:
+        images (Tensor): Shape: [batch,3,height,width]
+    Return:
+        h, s, v (Tensor): Shape: [batch,height,width]
+    """
+    r, g, b = images.unbind(1)
+    v, _ = images.max(1)
+    delta = v - images.min(1)[0]
+    s = torch.where(v != 0, delta / v, torch.zeros_like(v))
+    safe_delta = torch.where(delta != 0, delta, torch.ones_like(delta))
+    h = torch.where(v == r, (g - b) / safe_delta,
+                    torch.where(v == g, 2 + (b - r) / safe_delta, 4 + (r - g) / safe_delta))
+    h = torch.where(delta != 0, (h * 60) % 360, torch.zeros_like(h))
+    return h, s, v
+
+
+def hsv_to_rgb(h, s, v):
+    """Inverse of rgb_to_hsv, returns a [batch,3,height,width] rgb tensor"""
+    # channel = v - v * s * clamp(min(k, 4 - k), 0, 1) with k = (n + h / 60) % 6
+    # and n = 5, 3, 1 for r, g, b
+    n = torch.tensor([5, 3, 1], dtype=h.dtype, device=h.device).view(1, 3, 1, 1)
+    k = (n + (h / 60).unsqueeze(1)) % 6
+    return v.unsqueeze(1) - (v * s).unsqueeze(1) * torch.min(k, 4 - k).clamp(min=0, max=1)
+
+
+@lru_cache(maxsize=None)
+def _distort_constants(perms, mean, device, dtype):
+    """Channel permutations and bgr mean of GPUPhotometricDistort, built once per device"""
+    return (torch.tensor(perms, device=device),
+            torch.tensor(mean[::-1], dtype=dtype, device=device).view(1, 3, 1, 1))
+
+
+class GPUPhotometricDistort(object):
+    """Batched version of PhotometricDistort followed by SubtractMeans, for
+    images already stacked and moved to the gpu. Every random choice is still
+    drawn independently for each image of the batch.
+    """
+    def __init__(self, mean=(104, 117, 123)):
+        self.mean = tuple(mean)
+        self.perms = RandomLightingNoise().perms
+
+    def random_factor(self, images, lower, upper, identity):
+        """uniform(lower, upper) for half of the images, identity for the others"""
+        n = images.size(0)
+        factor = torch.empty(n, device=images.device).uniform_(lower, upper)
+        apply = torch.rand(n, device=images.device) < 0.5
+        return torch.where(apply, factor, torch.full_like(factor, identity))
+
+    def __call__(self, images):
+        """
+        Args:
+            images (Tensor): rgb images in [0, 255], Shape: [batch,3,height,width]
+        Return:
+            distorted and mean subtracted images
+        """
+        n = images.size(0)
+        # RandomBrightness
+        images = images + self.random_factor(images, -32, 32, 0).view(n, 1, 1, 1)
+        # RandomContrast, either before or after the hsv distortion
+        contrast = self.random_factor(images, 0.5, 1.5, 1).view(n, 1, 1, 1)
+        contrast_first = (torch.rand(n, device=images.device) < 0.5).view(n, 1, 1, 1)
+        images = images * torch.where(contrast_first, contrast, torch.ones_like(contrast))
+        # RandomSaturation and RandomHue
+        h, s, v = rgb_to_hsv(images)
+        s = s * self.random_factor(images, 0.5, 1.5, 1).view(n, 1, 1)
+        h = (h + self.random_factor(images, -18.0, 18.0, 0).view(n, 1, 1)) % 360
+        images = hsv_to_rgb(h, s, v)
+        images = images * torch.where(contrast_first, torch.ones_like(contrast), contrast)
+        # RandomLightingNoise, perms[0] keeps the channel order
+        choice = torch.randint(len(self.perms), (n,), device=images.device)
+        choice = torch.where(torch.rand(n, device=images.device) < 0.5, choice, torch.zeros_like(choice))
+        all_perms, mean = _distort_constants(self.perms, self.mean, images.device, images.dtype)
+        perms = all_perms[choice]
+        images = images.gather(1, perms.view(n, 3, 1, 1).expand_as(images))
+        # SubtractMeans, the mean is given in bgr order
+        return images - mean